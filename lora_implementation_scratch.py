@@ -1,6 +1,7 @@
 import math
+import re
 from pathlib import Path
-from typing import Tuple, Optional
+from typing import Dict, Tuple, Optional, Union
 
 import torch
 import torch.nn as nn
@@ -21,36 +22,516 @@ class LoraRobertaSelfAttention(RobertaSelfAttention):
     We overwrite the forward method with the new LoRA logic.
 
     r: the rank of the matricies for LoRA
+    lora_alpha: the LoRA scaling factor, the LoRA output is scaled by lora_alpha / r
+    merge_weights: whether to fold the LoRA weights into the query and value weights in eval mode. If False, the
+        LoRA branch is computed separately (from cached weight deltas for ranks r > d / 2), which keeps the base
+        weights untouched (e.g. for swapping adapters)
+    lora_dtype: the dtype of the LoRA matricies, e.g. torch.bfloat16 to halve the memory traffic of the LoRA
+        down-projection. Defaults to the default dtype
+    use_cuda_graphs: whether to run the common forward path compiled with CUDA graphs in eval mode (for fixed
+        input shapes)
     config: The config of the Roberta Model, has to be passed as *args to work with super
     """
 
-    def __init__(self, r=8, *args, **kwargs):
+    def __init__(
+        self,
+        r=8,
+        lora_alpha=8,
+        merge_weights=True,
+        lora_dtype=None,
+        use_cuda_graphs=False,
+        *args,
+        **kwargs,
+    ):
         super().__init__(*args, **kwargs)
         d = self.all_head_size
+        self._attn_scale = 1.0 / math.sqrt(self.attention_head_size)
+
+        # Fuse the query and value linear layers into a single layer of output dim 2d, such that both
+        # projections are computed with one matmul. The state dict hooks below translate between the fused
+        # qv.* and the regular query.* / value.* keys, so checkpoints stay compatible with RobertaSelfAttention.
+        self.qv = nn.Linear(self.query.in_features, 2 * d)
+        with torch.no_grad():
+            self.qv.weight.copy_(torch.cat([self.query.weight, self.value.weight]))
+            self.qv.bias.copy_(torch.cat([self.query.bias, self.value.bias]))
+        del self.query
+        del self.value
+        self._register_state_dict_hook(LoraRobertaSelfAttention._split_qv_state_dict)
+        self._register_load_state_dict_pre_hook(
+            LoraRobertaSelfAttention._fuse_qv_state_dict, with_module=True
+        )
+        self.register_load_state_dict_post_hook(
+            LoraRobertaSelfAttention._merge_after_load
+        )
+
+        # Initialize trainable matrices for query and value vectors, stacked along the first dimension (0: query,
+        # 1: value), such that both LoRA branches can be computed with batched matmuls.
+        self.lora_A = nn.Parameter(torch.empty(2, r, d, dtype=lora_dtype))
+        self.lora_B = nn.Parameter(torch.empty(2, d, r, dtype=lora_dtype))
+        self.reset_lora_parameters()
+        self._register_load_state_dict_pre_hook(
+            LoraRobertaSelfAttention._stack_lora_state_dict, with_module=True
+        )
+
+        # Scaling of the LoRA output, such that the magnitude of the update does not depend on the rank
+        self.r = r
+        self.scaling = lora_alpha / r if r > 0 else 0.0
+
+        # Whether the LoRA deltas are currently folded into the query and value weights
+        self.merge_weights = merge_weights
+        self._merged = False
+
+        # Cache for the stacked weight deltas [B_q@A_q; B_v@A_v], used in eval mode for large ranks if the weights
+        # are not merged
+        self.register_buffer("_cached_delta_qv", None, persistent=False)
+        self._cached_delta_version = None
+
+        # Static buffers for the relative position ids, such that the forward pass does not allocate new tensors
+        # for them, which keeps it CUDA graph capturable
+        if self.position_embedding_type in ("relative_key", "relative_key_query"):
+            for name in ("_position_ids", "_decode_position_ids"):
+                self.register_buffer(
+                    name,
+                    torch.empty(self.max_position_embeddings, dtype=torch.long),
+                    persistent=False,
+                )
+            self._reset_position_ids()
+
+        self.use_cuda_graphs = use_cuda_graphs
+        self._forward_fast_compiled = None
+
+    @classmethod
+    def from_self_attention(cls, module, **kwargs):
+        """Creates a LoraRobertaSelfAttention, which reuses the key, dropout and distance embedding submodules of
+        an existing RobertaSelfAttention module. The new layer is built on the meta device, such that its base
+        weights are never allocated or initialized. Only the fused qv layer (copied from the query and value of
+        the module), the LoRA parameters and the position id buffers are allocated. They use the dtype of the
+        module (unless a lora_dtype is given), and the layer takes over the training mode of the module.
+
+        kwargs: the arguments of LoraRobertaSelfAttention, including the config
+        """
+        dtype = module.query.weight.dtype
+        if kwargs.get("lora_dtype") is None:
+            kwargs["lora_dtype"] = dtype
+        with torch.device("meta"):
+            layer = cls(**kwargs)
+        layer.qv.to(dtype=dtype)
+        # Remove the submodules, which are taken from the module, before allocating the rest of the layer
+        del layer.key
+        if hasattr(layer, "distance_embedding"):
+            del layer.distance_embedding
+        layer.to_empty(device=module.key.weight.device)
+
+        layer.key = module.key
+        layer.dropout = module.dropout
+        if hasattr(module, "distance_embedding"):
+            layer.distance_embedding = module.distance_embedding
+        with torch.no_grad():
+            for name in ("weight", "bias"):
+                query_param, value_param = getattr(layer.qv, name).chunk(2, dim=0)
+                query_param.copy_(getattr(module.query, name))
+                value_param.copy_(getattr(module.value, name))
+        layer.reset_lora_parameters()
+        if hasattr(layer, "_position_ids"):
+            layer._reset_position_ids()
+        # The reused submodules keep the mode of the module, so the new layer has to match it
+        return layer.train(module.training)
+
+    @torch.no_grad()
+    def reset_lora_parameters(self):
+        """Initializes B as zeros and A as kaiming uniform (as in the reference implementation), such that their
+        product and thus the weight delta is zero in the beginning."""
+        for i in range(2):
+            nn.init.kaiming_uniform_(self.lora_A[i], a=math.sqrt(5))
+        nn.init.zeros_(self.lora_B)
+
+    @torch.no_grad()
+    def _reset_position_ids(self):
+        """Fills the static buffers for the relative position ids."""
+        torch.arange(self.max_position_embeddings, out=self._position_ids)
+        # Position ids for decoding with a cache, where only the last position attends to all keys:
+        # max_position_embeddings + key_length - 2 down to max_position_embeddings - 1 are the last
+        # key_length entries of this buffer
+        torch.arange(
+            2 * self.max_position_embeddings - 2,
+            self.max_position_embeddings - 2,
+            -1,
+            out=self._decode_position_ids,
+        )
+
+    def _split_qv_state_dict(self, state_dict, prefix, local_metadata):
+        """State dict hook, which splits the fused qv parameters into the query and value parameters. If the LoRA
+        weights are merged, the unmerged weights are saved, such that checkpoints do not depend on the mode.
+        """
+        if self._merged:
+            with torch.no_grad():
+                weight_key = prefix + "qv.weight"
+                state_dict[weight_key] = state_dict[weight_key] - self._get_delta()
+        for name in ("weight", "bias"):
+            query, value = state_dict.pop(prefix + "qv." + name).chunk(2, dim=0)
+            state_dict[prefix + "query." + name] = query
+            state_dict[prefix + "value." + name] = value
+
+    def _fuse_qv_state_dict(self, state_dict, prefix, *args):
+        """Load state dict pre hook, which fuses the query and value parameters into the qv parameters. Checkpoints
+        hold unmerged weights, so the LoRA weights are unmerged before loading (and merged again afterwards).
+        """
+        self.unmerge_lora()
+        for name in ("weight", "bias"):
+            query_key = prefix + "query." + name
+            value_key = prefix + "value." + name
+            if query_key in state_dict and value_key in state_dict:
+                state_dict[prefix + "qv." + name] = torch.cat(
+                    [state_dict.pop(query_key), state_dict.pop(value_key)]
+                )
+
+    def _stack_lora_state_dict(self, state_dict, prefix, *args):
+        """Load state dict pre hook, which stacks the separate LoRA matricies of older checkpoints
+        (lora_query_matrix_A, lora_value_matrix_A, ...) into lora_A and lora_B."""
+        for name in ("A", "B"):
+            query_key = prefix + "lora_query_matrix_" + name
+            value_key = prefix + "lora_value_matrix_" + name
+            if query_key in state_dict and value_key in state_dict:
+                state_dict[prefix + "lora_" + name] = torch.stack(
+                    [state_dict.pop(query_key), state_dict.pop(value_key)]
+                )
+
+    @property
+    def lora_query_matrix_A(self):
+        """The A matrix of the query of shape (r, d), a view into lora_A."""
+        return self.lora_A[0]
+
+    @property
+    def lora_query_matrix_B(self):
+        """The B matrix of the query of shape (d, r), a view into lora_B."""
+        return self.lora_B[0]
+
+    @property
+    def lora_value_matrix_A(self):
+        """The A matrix of the value of shape (r, d), a view into lora_A."""
+        return self.lora_A[1]
+
+    @property
+    def lora_value_matrix_B(self):
+        """The B matrix of the value of shape (d, r), a view into lora_B."""
+        return self.lora_B[1]
+
+    @torch.no_grad()
+    def _get_delta(self):
+        """Returns the stacked and scaled weight deltas [B_q@A_q; B_v@A_v] of shape (2d, d) in the dtype of the
+        qv weight."""
+        delta_qv = torch.bmm(self.lora_B, self.lora_A).flatten(0, 1)
+        return delta_qv.to(self.qv.weight.dtype).mul_(self.scaling)
+
+    @torch.no_grad()
+    def merge_lora(self):
+        """Folds the LoRA weight deltas B@A into the query and value weights, such that the forward pass
+        only needs the regular linear layers. Called automatically when switching to eval mode.
+        """
+        if self._merged:
+            return
+        self.qv.weight.add_(self._get_delta())
+        self._merged = True
+
+    @torch.no_grad()
+    def unmerge_lora(self):
+        """Subtracts the LoRA weight deltas from the query and value weights again, restoring the original
+        weights. Called automatically when switching to training mode."""
+        if not self._merged:
+            return
+        self.qv.weight.sub_(self._get_delta())
+        self._merged = False
+
+    def _merge_after_load(self, incompatible_keys):
+        """Load state dict post hook, which merges the loaded LoRA weights again if we are in eval mode."""
+        if not self.training and self.merge_weights:
+            self.merge_lora()
+
+    def train(self, mode: bool = True):
+        """Merges the LoRA weights when entering eval mode and unmerges them when entering training mode,
+        so inference runs on a single linear layer per projection."""
+        super().train(mode)
+        if mode:
+            self.unmerge_lora()
+            self._cached_delta_qv = None
+        elif self.merge_weights:
+            self.merge_lora()
+        return self
+
+    def _skip_lora(self):
+        """Whether the LoRA branch can be skipped, because it is always zero for r == 0."""
+        return self.r == 0
+
+    def _use_cached_delta(self):
+        """Whether the LoRA weight deltas should be taken from the cache, i.e. if we are in eval mode, no
+        gradients are needed for the LoRA parameters and the dense delta is cheaper. Per input row, the dense
+        delta costs d * d multiply-adds per projection, the rank r path 2 * r * d, so the cache only pays off
+        for r > d / 2. For smaller ranks (the usual case) the rank r path is used, or the weights are merged.
+        """
+        return (
+            not self.training
+            and 2 * self.r > self.all_head_size
+            and not (torch.is_grad_enabled() and self.lora_B.requires_grad)
+        )
 
-        # Initialize trainable matrices for query and value vectors
-        # B should be initialized as zeros, A as random gaussian, such that their product and
-        # thus the weight delta is zero in the beginning
-        self.lora_query_matrix_B = nn.Parameter(torch.zeros(d, r))
-        self.lora_query_matrix_A = nn.Parameter(torch.randn(r, d))
-        self.lora_value_matrix_B = nn.Parameter(torch.zeros(d, r))
-        self.lora_value_matrix_A = nn.Parameter(torch.randn(r, d))
+    @torch.no_grad()
+    def _get_cached_delta(self):
+        """Returns the stacked and scaled weight deltas [B_q@A_q; B_v@A_v] of shape (2d, d). They are only recomputed
+        if one of the LoRA parameters changed since the last call, tracked via their version counters and data
+        pointers (assigning to .data does not bump the version counter).
+        """
+        version = tuple(
+            (param.data_ptr(), param._version) for param in (self.lora_A, self.lora_B)
+        )
+        if self._cached_delta_qv is None or version != self._cached_delta_version:
+            self._cached_delta_qv = self._get_delta()
+            self._cached_delta_version = version
+        return self._cached_delta_qv
+
+    @staticmethod
+    def _addmm(base, x, weight, alpha=1.0):
+        """Returns base + alpha * F.linear(x, weight). The matmul, the scaling and the residual add are fused
+        into a single addmm call, which avoids allocating the output of F.linear."""
+        out = torch.addmm(
+            base.reshape(-1, base.shape[-1]),
+            x.reshape(-1, x.shape[-1]),
+            weight.t(),
+            alpha=alpha,
+        )
+        return out.view(base.shape)
+
+    def _add_lora(self, base, x, lora_A, lora_B):
+        """Returns base + scaling * F.linear(F.linear(x, A), B). The down-projection, which reads the full
+        input, runs in the dtype of the LoRA matricies. The small result is cast back to the dtype of base
+        for the fused up-projection and residual add. Autocast is disabled to not cast twice.
+        """
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            # Apply A (down-projection to rank r) before B (up-projection), which never materializes
+            # the d x d weight delta B@A
+            lora_down = F.linear(x.to(lora_A.dtype), lora_A)
+            return self._addmm(
+                base,
+                lora_down.to(base.dtype),
+                lora_B.to(base.dtype),
+                alpha=self.scaling,
+            )
 
     def lora_query(self, x):
         """LoRA query logic. To fully work with only training the LoRA parameters the regular linear
         layer has to be frozen before initializing the optimizer."""
-        lora_full_query_weights = torch.matmul(
-            self.lora_query_matrix_B, self.lora_query_matrix_A
+        query_weight, _ = self.qv.weight.chunk(2, dim=0)
+        query_bias, _ = self.qv.bias.chunk(2, dim=0)
+        query = F.linear(x, query_weight, query_bias)
+        if self._merged or self._skip_lora():
+            return query
+        if self._use_cached_delta():
+            delta_query, _ = self._get_cached_delta().chunk(2, dim=0)
+            return self._addmm(query, x, delta_query)
+        return self._add_lora(
+            query, x, self.lora_query_matrix_A, self.lora_query_matrix_B
         )
-        return self.query(x) + F.linear(x, lora_full_query_weights)
 
     def lora_value(self, x):
         """LoRA value logic. To fully work with only training the LoRA parameters the regular linear
         layer has to be frozen before initializing the optimizer."""
-        lora_full_value_weights = torch.matmul(
-            self.lora_value_matrix_B, self.lora_value_matrix_A
+        _, value_weight = self.qv.weight.chunk(2, dim=0)
+        _, value_bias = self.qv.bias.chunk(2, dim=0)
+        value = F.linear(x, value_weight, value_bias)
+        if self._merged or self._skip_lora():
+            return value
+        if self._use_cached_delta():
+            _, delta_value = self._get_cached_delta().chunk(2, dim=0)
+            return self._addmm(value, x, delta_value)
+        return self._add_lora(
+            value, x, self.lora_value_matrix_A, self.lora_value_matrix_B
+        )
+
+    def lora_query_value(self, x):
+        """Fused LoRA query and value logic, used when query and value are computed from the same input.
+        Both projections are computed with one matmul against the fused qv layer and one batched LoRA down-
+        and up-projection against the stacked LoRA matrices. Returns the query and the value.
+        """
+        mixed_layer = self.qv(x)
+        if self._merged or self._skip_lora():
+            return mixed_layer.chunk(2, dim=-1)
+        if self._use_cached_delta():
+            mixed_layer = self._addmm(mixed_layer, x, self._get_cached_delta())
+            return mixed_layer.chunk(2, dim=-1)
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            x_2d = x.reshape(-1, x.shape[-1]).to(self.lora_A.dtype)
+            # (2, n, d) @ (2, d, r) -> (2, n, r)
+            lora_down = torch.bmm(
+                x_2d.expand(2, *x_2d.shape), self.lora_A.transpose(1, 2)
+            )
+            # (2, n, d) + (2, n, r) @ (2, r, d) -> (2, n, d), the residual add is fused into the matmul
+            mixed_layer = torch.baddbmm(
+                mixed_layer.reshape(-1, 2, self.all_head_size).transpose(0, 1),
+                lora_down.to(mixed_layer.dtype),
+                self.lora_B.transpose(1, 2).to(mixed_layer.dtype),
+                alpha=self.scaling,
+            )
+        output_shape = x.shape[:-1] + (self.all_head_size,)
+        return mixed_layer[0].view(output_shape), mixed_layer[1].view(output_shape)
+
+    @staticmethod
+    def _relative_position_scores_query(query_layer, positional_embedding):
+        """Equivalent to torch.einsum("bhld,lrd->bhlr", query_layer, positional_embedding), but computed as a
+        single batched matmul over the query positions l. When decoding with a cache the embedding has a single
+        query position, which is broadcast to all query positions (as in the einsum)."""
+        batch_size, num_heads, query_length, head_size = query_layer.shape
+        positional_embedding = positional_embedding.expand(query_length, -1, -1)
+        # (l, b*h, d) @ (l, d, r) -> (l, b*h, r)
+        scores = torch.bmm(
+            query_layer.permute(2, 0, 1, 3).reshape(query_length, -1, head_size),
+            positional_embedding.transpose(1, 2),
+        )
+        return scores.view(query_length, batch_size, num_heads, -1).permute(1, 2, 0, 3)
+
+    @staticmethod
+    def _relative_position_scores_key(key_layer_t, positional_embedding):
+        """Equivalent to torch.einsum("bhrd,lrd->bhlr", key_layer, positional_embedding), but takes the
+        transposed key layer of shape (b, h, d, r), which is shared with the attention scores matmul, and is
+        computed as a single batched matmul over the key positions r."""
+        batch_size, num_heads, head_size, key_length = key_layer_t.shape
+        # (r, l, d) @ (r, d, b*h) -> (r, l, b*h)
+        scores = torch.bmm(
+            positional_embedding.transpose(0, 1),
+            key_layer_t.permute(3, 2, 0, 1).reshape(key_length, head_size, -1),
+        )
+        return scores.view(key_length, -1, batch_size, num_heads).permute(2, 3, 1, 0)
+
+    def _get_positional_embedding(self, query_length, key_length, use_cache, dtype):
+        """Returns the relative positional embedding of shape (query_length, key_length, head_size). The position
+        ids are taken from static buffers, so computing them needs no host to device copy.
+        """
+        if use_cache:
+            # Only the last position attends to all keys, its position ids are a view of a static buffer
+            position_ids = self._decode_position_ids[-key_length:].view(1, -1)
+        else:
+            position_ids_l = self._position_ids[:query_length].view(-1, 1)
+            position_ids_r = self._position_ids[:key_length].view(1, -1)
+            position_ids = (
+                position_ids_l - position_ids_r + self.max_position_embeddings - 1
+            )
+        return self.distance_embedding(position_ids).to(dtype=dtype)
+
+    def _sdpa_attention(self, query_layer, key_layer, value_layer, attention_mask):
+        """Fused attention kernel (FlashAttention / memory efficient attention on CUDA), which never materializes
+        the full attention scores. Returns the context layer of shape (b, h, l, head_size).
+        """
+        return F.scaled_dot_product_attention(
+            query_layer,
+            key_layer,
+            value_layer,
+            attn_mask=attention_mask,
+            dropout_p=self.dropout.p if self.training else 0.0,
+        )
+
+    def _merge_heads(self, context_layer):
+        """Merges the heads of the context layer (b, h, l, head_size) -> (b, l, all_head_size). reshape only copies
+        if needed, SDPA often returns a layout for which the permuted tensor is contiguous.
+        """
+        context_layer = context_layer.permute(0, 2, 1, 3)
+        new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
+        return context_layer.reshape(new_context_layer_shape)
+
+    def _forward_fast(self, hidden_states, attention_mask):
+        """Common path of the forward pass: self-attention with absolute position embeddings, without a cache,
+        head mask or returned attention probabilities. Free of Python branching on the inputs, such that it can
+        be compiled into a few fused kernels."""
+        mixed_query_layer, mixed_value_layer = self.lora_query_value(hidden_states)
+        query_layer = self.transpose_for_scores(mixed_query_layer)
+        key_layer = self.transpose_for_scores(self.key(hidden_states))
+        value_layer = self.transpose_for_scores(mixed_value_layer)
+        context_layer = self._sdpa_attention(
+            query_layer, key_layer, value_layer, attention_mask
         )
-        return self.value(x) + F.linear(x, lora_full_value_weights)
+        return (self._merge_heads(context_layer),)
+
+    def _get_forward_fast_compiled(self):
+        """Returns the fast path compiled with CUDA graphs, which are captured on warmup and replayed for inputs of
+        the same shape. It is compiled per instance on first use, such that importing this module never compiles
+        and the parameters of every layer are static inputs of its own graphs. Every layer and input shape adds an
+        entry to the compile cache of _forward_fast, so for models with many layers the cache size limit of
+        torch._dynamo.config may have to be raised, otherwise torch falls back to eager once it is hit.
+        """
+        if self._forward_fast_compiled is None:
+            self._forward_fast_compiled = torch.compile(
+                self._forward_fast, mode="reduce-overhead", dynamic=False
+            )
+        return self._forward_fast_compiled
+
+    def _eager_attention(
+        self,
+        query_layer: torch.Tensor,
+        key_layer: torch.Tensor,
+        value_layer: torch.Tensor,
+        attention_mask: Optional[torch.FloatTensor],
+        head_mask: Optional[torch.FloatTensor],
+        use_cache: bool,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Regular attention logic, used for relative position embeddings, head masks or if the attention
+        probabilities should be returned. Returns the context layer and the attention probabilities.
+        """
+        # Scale the query instead of the (larger) attention scores. This also scales the relative position
+        # scores computed from the query.
+        query_layer = query_layer * self._attn_scale
+
+        # Take the dot product between "query" and "key" to get the raw attention scores.
+        # The transposed key is shared with the relative position scores of the key. It stays a view, as a
+        # contiguous copy makes both matmuls slower.
+        key_layer_t = key_layer.transpose(-1, -2)
+        attention_scores = torch.matmul(query_layer, key_layer_t)
+
+        if (
+            self.position_embedding_type == "relative_key"
+            or self.position_embedding_type == "relative_key_query"
+        ):
+            query_length, key_length = query_layer.shape[2], key_layer_t.shape[3]
+            positional_embedding = self._get_positional_embedding(
+                query_length, key_length, use_cache, dtype=query_layer.dtype
+            )  # cast for fp16 compatibility
+
+            if self.position_embedding_type == "relative_key":
+                relative_position_scores = self._relative_position_scores_query(
+                    query_layer, positional_embedding
+                )
+                attention_scores = attention_scores + relative_position_scores
+            elif self.position_embedding_type == "relative_key_query":
+                relative_position_scores_query = self._relative_position_scores_query(
+                    query_layer, positional_embedding
+                )
+                relative_position_scores_key = self._relative_position_scores_key(
+                    key_layer_t, positional_embedding
+                )
+                # The key scores are computed with the unscaled key, so they are scaled while adding them
+                attention_scores = torch.add(
+                    attention_scores + relative_position_scores_query,
+                    relative_position_scores_key,
+                    alpha=self._attn_scale,
+                )
+
+        if attention_mask is not None:
+            # Apply the attention mask is (precomputed for all layers in RobertaModel forward() function)
+            # The scores are always a freshly computed tensor, which is not needed for backward, so the
+            # mask is added in place instead of allocating another (b, h, l, l) tensor
+            attention_scores.add_(attention_mask)
+
+        # Normalize the attention scores to probabilities.
+        attention_probs = nn.functional.softmax(attention_scores, dim=-1)
+        # Softmax only keeps its output for backward, so the scores can be freed right away
+        del attention_scores
+
+        # This is actually dropping out entire tokens to attend to, which might
+        # seem a bit unusual, but is taken from the original Transformer paper.
+        attention_probs = self.dropout(attention_probs)
+
+        # Mask heads if we want to
+        if head_mask is not None:
+            attention_probs = attention_probs * head_mask
+
+        context_layer = torch.matmul(attention_probs, value_layer)
+        return context_layer, attention_probs
 
     def forward(
         self,
@@ -63,15 +544,30 @@ class LoraRobertaSelfAttention(RobertaSelfAttention):
         output_attentions: Optional[bool] = False,
     ) -> Tuple[torch.Tensor]:
         """Copied from https://github.com/huggingface/transformers/blob/main/src/transformers/models/roberta/modeling_roberta.py
-        but replaced the query and value calls with calls to the lora_query and lora_value functions.
+        but replaced the query and value calls with calls to the lora_query_value, lora_query and lora_value functions.
         """
-        mixed_query_layer = self.lora_query(hidden_states)
+        if (
+            encoder_hidden_states is None
+            and past_key_value is None
+            and not self.is_decoder
+            and self.position_embedding_type == "absolute"
+            and head_mask is None
+            and not output_attentions
+        ):
+            if self.use_cuda_graphs and not self.training and hidden_states.is_cuda:
+                return self._get_forward_fast_compiled()(hidden_states, attention_mask)
+            return self._forward_fast(hidden_states, attention_mask)
 
         # If this is instantiated as a cross-attention module, the keys
         # and values come from an encoder; the attention mask needs to be
         # such that the encoder's padding tokens are not attended to.
         is_cross_attention = encoder_hidden_states is not None
 
+        if is_cross_attention:
+            mixed_query_layer = self.lora_query(hidden_states)
+        else:
+            mixed_query_layer, mixed_value_layer = self.lora_query_value(hidden_states)
+
         if is_cross_attention and past_key_value is not None:
             # reuse k,v, cross_attentions
             key_layer = past_key_value[0]
@@ -85,12 +581,12 @@ class LoraRobertaSelfAttention(RobertaSelfAttention):
             attention_mask = encoder_attention_mask
         elif past_key_value is not None:
             key_layer = self.transpose_for_scores(self.key(hidden_states))
-            value_layer = self.transpose_for_scores(self.lora_value(hidden_states))
+            value_layer = self.transpose_for_scores(mixed_value_layer)
             key_layer = torch.cat([past_key_value[0], key_layer], dim=2)
             value_layer = torch.cat([past_key_value[1], value_layer], dim=2)
         else:
             key_layer = self.transpose_for_scores(self.key(hidden_states))
-            value_layer = self.transpose_for_scores(self.lora_value(hidden_states))
+            value_layer = self.transpose_for_scores(mixed_value_layer)
 
         query_layer = self.transpose_for_scores(mixed_query_layer)
 
@@ -105,73 +601,25 @@ class LoraRobertaSelfAttention(RobertaSelfAttention):
             # if encoder bi-directional self-attention `past_key_value` is always `None`
             past_key_value = (key_layer, value_layer)
 
-        # Take the dot product between "query" and "key" to get the raw attention scores.
-        attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
-
         if (
-            self.position_embedding_type == "relative_key"
-            or self.position_embedding_type == "relative_key_query"
+            self.position_embedding_type == "absolute"
+            and head_mask is None
+            and not output_attentions
         ):
-            query_length, key_length = query_layer.shape[2], key_layer.shape[2]
-            if use_cache:
-                position_ids_l = torch.tensor(
-                    key_length - 1, dtype=torch.long, device=hidden_states.device
-                ).view(-1, 1)
-            else:
-                position_ids_l = torch.arange(
-                    query_length, dtype=torch.long, device=hidden_states.device
-                ).view(-1, 1)
-            position_ids_r = torch.arange(
-                key_length, dtype=torch.long, device=hidden_states.device
-            ).view(1, -1)
-            distance = position_ids_l - position_ids_r
-
-            positional_embedding = self.distance_embedding(
-                distance + self.max_position_embeddings - 1
+            context_layer = self._sdpa_attention(
+                query_layer, key_layer, value_layer, attention_mask
+            )
+        else:
+            context_layer, attention_probs = self._eager_attention(
+                query_layer,
+                key_layer,
+                value_layer,
+                attention_mask,
+                head_mask,
+                use_cache,
             )
-            positional_embedding = positional_embedding.to(
-                dtype=query_layer.dtype
-            )  # fp16 compatibility
-
-            if self.position_embedding_type == "relative_key":
-                relative_position_scores = torch.einsum(
-                    "bhld,lrd->bhlr", query_layer, positional_embedding
-                )
-                attention_scores = attention_scores + relative_position_scores
-            elif self.position_embedding_type == "relative_key_query":
-                relative_position_scores_query = torch.einsum(
-                    "bhld,lrd->bhlr", query_layer, positional_embedding
-                )
-                relative_position_scores_key = torch.einsum(
-                    "bhrd,lrd->bhlr", key_layer, positional_embedding
-                )
-                attention_scores = (
-                    attention_scores
-                    + relative_position_scores_query
-                    + relative_position_scores_key
-                )
-
-        attention_scores = attention_scores / math.sqrt(self.attention_head_size)
-        if attention_mask is not None:
-            # Apply the attention mask is (precomputed for all layers in RobertaModel forward() function)
-            attention_scores = attention_scores + attention_mask
-
-        # Normalize the attention scores to probabilities.
-        attention_probs = nn.functional.softmax(attention_scores, dim=-1)
-
-        # This is actually dropping out entire tokens to attend to, which might
-        # seem a bit unusual, but is taken from the original Transformer paper.
-        attention_probs = self.dropout(attention_probs)
-
-        # Mask heads if we want to
-        if head_mask is not None:
-            attention_probs = attention_probs * head_mask
 
-        context_layer = torch.matmul(attention_probs, value_layer)
-
-        context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
-        new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
-        context_layer = context_layer.view(new_context_layer_shape)
+        context_layer = self._merge_heads(context_layer)
 
         outputs = (
             (context_layer, attention_probs) if output_attentions else (context_layer,)
@@ -187,6 +635,10 @@ class LoraWrapperRobertaHelper:
         self,
         model_id: str = "roberta-base",
         lora_rank: int = 8,
+        lora_alpha: int = 8,
+        lora_dtype: Optional[torch.dtype] = None,
+        merge_weights: bool = True,
+        use_cuda_graphs: bool = False,
         train_biases: bool = True,
         train_embedding: bool = False,
         train_layer_norms: bool = True,
@@ -202,6 +654,15 @@ class LoraWrapperRobertaHelper:
             Identifier for the pre-trained RoBERTa model to be loaded.
         lora_rank : int, default 8
             Rank of the adaptation applied to the attention layers via LoRA.
+        lora_alpha : int, default 8
+            Scaling factor of the LoRA update, which is scaled by lora_alpha / lora_rank.
+        lora_dtype : torch.dtype, optional
+            Dtype of the LoRA parameters, e.g. torch.bfloat16. Defaults to the dtype of the model.
+        merge_weights : bool, default True
+            Flag indicating whether to fold the LoRA weights into the query and value weights in eval mode.
+        use_cuda_graphs : bool, default False
+            Flag indicating whether to run the attention layers compiled with CUDA graphs in eval mode (for fixed
+            input shapes).
         train_biases : bool, default True
             Flag indicating whether to update bias parameters during training.
         train_embedding : bool, default False
@@ -224,6 +685,10 @@ class LoraWrapperRobertaHelper:
         )  # save model config to use when setting the layers
 
         self.lora_rank = lora_rank
+        self.lora_alpha = lora_alpha
+        self.lora_dtype = lora_dtype
+        self.merge_weights = merge_weights
+        self.use_cuda_graphs = use_cuda_graphs
         self.train_biases = train_biases
         self.train_embeddings = train_embedding
         self.train_layer_norms = train_layer_norms
@@ -264,28 +729,31 @@ class LoraWrapperRobertaHelper:
             if isinstance(module, RobertaSelfAttention):
                 self.nr_replaced_modules += 1
 
-                # Create a new LoraMultiheadAttention layer
-                new_layer = LoraRobertaSelfAttention(
-                    r=self.lora_rank, config=self.model_config
+                # Create a new LoraMultiheadAttention layer, which reuses the submodules of the original layer
+                # instead of round-tripping its state dict. Its base weights are never allocated, only the fused
+                # query and value weights are new.
+                new_layer = LoraRobertaSelfAttention.from_self_attention(
+                    module,
+                    r=self.lora_rank,
+                    lora_alpha=self.lora_alpha,
+                    lora_dtype=self.lora_dtype,
+                    merge_weights=self.merge_weights,
+                    use_cuda_graphs=self.use_cuda_graphs,
+                    config=self.model_config,
                 )
 
-                # Get the state of the original layer
-                state_dict_old = module.state_dict()
-
-                # Load the state dict to the new layer
-                new_layer.load_state_dict(state_dict_old, strict=False)
-
-                # Get the state of the new layer
-                state_dict_new = new_layer.state_dict()
-
-                # Compare keys of both state dicts
-                keys_old = set(state_dict_old.keys())
-                keys_new = set(
-                    k for k in state_dict_new.keys() if not k.startswith("lora_")
-                )
-                assert (
-                    keys_old == keys_new
-                ), f"Keys of the state dictionaries don't match (ignoring lora parameters):\n\tExpected Parameters: {keys_old}\n\tNew Parameters (w.o. LoRA): {keys_new}"
+                # Compare keys of both state dicts. All attention layers share the same config, so checking
+                # the first one is enough.
+                if self.nr_replaced_modules == 1:
+                    keys_old = set(module.state_dict().keys())
+                    keys_new = set(
+                        k
+                        for k in new_layer.state_dict().keys()
+                        if not k.startswith("lora_")
+                    )
+                    assert (
+                        keys_old == keys_new
+                    ), f"Keys of the state dictionaries don't match (ignoring lora parameters):\n\tExpected Parameters: {keys_old}\n\tNew Parameters (w.o. LoRA): {keys_new}"
 
                 # Replace the original layer with the new layer
                 setattr(model, name, new_layer)
@@ -300,18 +768,23 @@ class LoraWrapperRobertaHelper:
         All lora parameters are identified by having a name that starts with *lora_*.
         All finetune head parameters are identified by having a name that starts with *finetune_head_*.
         """
+        # Build a single pattern of all trainable name parts, such that each name is only searched once
+        trainable_parts = ["lora_", "finetune_head_"]
+        if self.train_biases:
+            trainable_parts.append("bias")
+        if self.train_embeddings:
+            trainable_parts.append("embeddings")
+        if self.train_layer_norms:
+            trainable_parts.append("LayerNorm")
+        trainable_pattern = re.compile("|".join(trainable_parts))
+
         for name, param in self.model.named_parameters():
-            if (
-                ("lora_" in name)
-                or ("finetune_head_" in name)
-                or (self.train_biases and "bias" in name)
-                or (self.train_embeddings and "embeddings" in name)
-                or (self.train_layer_norms and "LayerNorm" in name)
-            ):
-                param.requires_grad = True
-            else:
-                param.requires_grad = False
+            param.requires_grad = trainable_pattern.search(name) is not None
 
+    @staticmethod
+    def load_lora(
+        lora_parameters: Union[str, Path, Dict],
+    ) -> "LoraWrapperRobertaHelper":
         """
         Load a state dict into the model from a specified file path or a state dict directly.
         This is a staticmethod to be used from the base clase, returning a fully initialized and LoRA loaded model.
@@ -321,7 +794,8 @@ class LoraWrapperRobertaHelper:
         lora_parameters : Union[str, Path, Dict]
             Either the file path to the state dict (can be a string or pathlib.Path) or the state dict itself. If a file path
             is provided, the function will load the state dict from the file. If a state dict is provided directly, the function
-            will use it as is.
+            will use it as is. Next to the LoRA parameters, the state dict has to contain the model_id and lora_rank
+            (and optionally lora_alpha) entries.
 
         Returns
         -------
@@ -345,9 +819,10 @@ class LoraWrapperRobertaHelper:
         instance = LoraWrapperRobertaHelper(
             model_id=state_dict["model_id"],
             lora_rank=state_dict["lora_rank"],
+            lora_alpha=state_dict.get("lora_alpha", 8),
         )
 
-        # Load the state dict into the model
-        instance.load_state_dict(state_dict, strict=False)
+        # Load the state dict into the model, the helper itself is not a module
+        instance.model.load_state_dict(state_dict, strict=False)
 
         return instance
@@ -0,0 +1,244 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+from lora_implementation_scratch import (
+    LoraRobertaSelfAttention,
+    LoraWrapperRobertaHelper,
+)
+
+
+def make_layer(r=4, **kwargs):
+    config = transformers.RobertaConfig(
+        hidden_size=32,
+        num_attention_heads=4,
+        attention_probs_dropout_prob=0.0,
+    )
+    layer = LoraRobertaSelfAttention(r=r, config=config, **kwargs)
+    # Give the LoRA branch a non-zero contribution
+    with torch.no_grad():
+        layer.lora_B.normal_()
+    return layer
+
+
+def test_merged_output_matches_unmerged_output():
+    torch.manual_seed(0)
+    layer = make_layer()
+    hidden_states = torch.randn(2, 5, 32)
+    weight_before = layer.qv.weight.detach().clone()
+    with torch.no_grad():
+        expected = layer(hidden_states)[0]
+        output = layer.eval()(hidden_states)[0]
+    torch.testing.assert_close(output, expected)
+
+    # Merging and unmerging again has to restore the original weights
+    layer.train()
+    torch.testing.assert_close(layer.qv.weight, weight_before)
+
+
+def test_state_dict_round_trip_in_eval_mode():
+    torch.manual_seed(0)
+    layer = make_layer()
+    hidden_states = torch.randn(2, 5, 32)
+    layer.eval()
+    expected = layer(hidden_states)[0]
+
+    state_dict = layer.state_dict()
+    layer.train()
+    unmerged = layer.state_dict()
+    for key in unmerged:
+        torch.testing.assert_close(state_dict[key], unmerged[key])
+
+    loaded = make_layer()
+    loaded.load_state_dict(state_dict)
+    loaded.eval()
+    torch.testing.assert_close(loaded(hidden_states)[0], expected)
+
+
+def test_load_state_dict_while_merged():
+    torch.manual_seed(0)
+    layer = make_layer()
+    hidden_states = torch.randn(2, 5, 32)
+    layer.eval()
+    expected = layer(hidden_states)[0]
+    state_dict = layer.state_dict()
+
+    loaded = make_layer().eval()
+    loaded.load_state_dict(state_dict)
+    torch.testing.assert_close(loaded(hidden_states)[0], expected)
+
+    # Switching to training mode has to restore the unmerged base weights
+    loaded.train()
+    layer.train()
+    torch.testing.assert_close(loaded.qv.weight, layer.qv.weight)
+
+
+def test_cached_delta_follows_data_assignment():
+    torch.manual_seed(0)
+    # The dense delta is only cached for ranks r > d / 2
+    layer = make_layer(r=20, merge_weights=False).eval()
+    hidden_states = torch.randn(2, 5, 32)
+    with torch.no_grad():
+        layer(hidden_states)
+        layer.lora_B.data = torch.randn_like(layer.lora_B)
+        output = layer(hidden_states)[0]
+        layer.train()
+        expected = layer(hidden_states)[0]
+    torch.testing.assert_close(output, expected)
+
+
+def test_lora_branch_follows_data_assignment():
+    torch.manual_seed(0)
+    config = transformers.RobertaConfig(
+        hidden_size=32, num_attention_heads=4, attention_probs_dropout_prob=0.0
+    )
+    # B holds its zero initialization until it is replaced through .data
+    layer = LoraRobertaSelfAttention(r=4, config=config)
+    hidden_states = torch.randn(2, 5, 32)
+    with torch.no_grad():
+        base_output = layer(hidden_states)[0]
+        layer.lora_B.data = torch.randn_like(layer.lora_B)
+        output = layer(hidden_states)[0]
+    assert not torch.allclose(output, base_output)
+
+
+def make_roberta_pair(position_embedding_type, is_decoder=False):
+    """Returns a RobertaSelfAttention module and a LoraRobertaSelfAttention layer built from it."""
+    from transformers.models.roberta.modeling_roberta import RobertaSelfAttention
+
+    config = transformers.RobertaConfig(
+        hidden_size=32,
+        num_attention_heads=4,
+        attention_probs_dropout_prob=0.0,
+        position_embedding_type=position_embedding_type,
+        is_decoder=is_decoder,
+    )
+    module = RobertaSelfAttention(config)
+    layer = LoraRobertaSelfAttention.from_self_attention(module, r=4, config=config)
+    return module, layer
+
+
+@pytest.mark.parametrize(
+    "position_embedding_type", ["absolute", "relative_key", "relative_key_query"]
+)
+def test_from_self_attention(position_embedding_type):
+    torch.manual_seed(0)
+    module, layer = make_roberta_pair(position_embedding_type)
+    assert layer.key is module.key
+    assert not any(param.is_meta for param in layer.parameters())
+    assert not any(buffer.is_meta for buffer in layer.buffers())
+    torch.testing.assert_close(layer.lora_B, torch.zeros_like(layer.lora_B))
+
+    hidden_states = torch.randn(2, 5, 32)
+    with torch.no_grad():
+        torch.testing.assert_close(layer(hidden_states)[0], module(hidden_states)[0])
+
+
+def test_from_self_attention_keeps_mode_and_dtype():
+    module, _ = make_roberta_pair("absolute")
+    module = module.to(torch.bfloat16).eval()
+    config = transformers.RobertaConfig(hidden_size=32, num_attention_heads=4)
+    layer = LoraRobertaSelfAttention.from_self_attention(module, r=4, config=config)
+    assert not layer.training
+    assert layer.qv.weight.dtype == torch.bfloat16
+    assert layer.lora_A.dtype == torch.bfloat16
+
+
+@pytest.mark.parametrize(
+    "position_embedding_type", ["absolute", "relative_key", "relative_key_query"]
+)
+def test_decoding_with_cache(position_embedding_type):
+    torch.manual_seed(0)
+    module, layer = make_roberta_pair(position_embedding_type, is_decoder=True)
+    hidden_states = torch.randn(2, 1, 32)
+    past_key_value = (torch.randn(2, 4, 6, 8), torch.randn(2, 4, 6, 8))
+    with torch.no_grad():
+        expected = module(hidden_states, past_key_value=past_key_value)
+        output = layer(hidden_states, past_key_value=past_key_value)
+    torch.testing.assert_close(output[0], expected[0])
+    # The updated cache holds the past and the new keys and values
+    torch.testing.assert_close(output[-1], expected[-1])
+
+
+@pytest.mark.parametrize(
+    "position_embedding_type", ["relative_key", "relative_key_query"]
+)
+def test_multiple_new_tokens_with_cache(position_embedding_type):
+    torch.manual_seed(0)
+    module, layer = make_roberta_pair(position_embedding_type, is_decoder=True)
+    hidden_states = torch.randn(2, 2, 32)
+    past_key_value = (torch.randn(2, 4, 3, 8), torch.randn(2, 4, 3, 8))
+    with torch.no_grad():
+        expected = module(hidden_states, past_key_value=past_key_value)[0]
+        output = layer(hidden_states, past_key_value=past_key_value)[0]
+    torch.testing.assert_close(output, expected)
+
+
+@pytest.fixture
+def tiny_roberta(tmp_path):
+    """Saves a small RobertaModel, such that the helper can load it with from_pretrained."""
+    config = transformers.RobertaConfig(
+        vocab_size=100,
+        hidden_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        intermediate_size=64,
+        attention_probs_dropout_prob=0.0,
+        hidden_dropout_prob=0.0,
+    )
+    model = transformers.RobertaModel(config).eval()
+    model.save_pretrained(tmp_path)
+    return str(tmp_path), model
+
+
+def test_lora_wrapper_roberta_helper(tiny_roberta):
+    model_id, base_model = tiny_roberta
+    helper = LoraWrapperRobertaHelper(model_id=model_id, lora_rank=4)
+    assert helper.nr_replaced_modules == 2
+    for name, param in helper.model.named_parameters():
+        trainable = any(part in name for part in ("lora_", "bias", "LayerNorm"))
+        assert param.requires_grad == trainable, name
+
+    # B starts at zero, so the outputs match the base model
+    input_ids = torch.randint(0, 100, (2, 7))
+    with torch.no_grad():
+        torch.testing.assert_close(
+            helper.model(input_ids).last_hidden_state,
+            base_model(input_ids).last_hidden_state,
+        )
+
+    # Round trip of the LoRA parameters through load_lora
+    helper.model.train()
+    with torch.no_grad():
+        for name, param in helper.model.named_parameters():
+            if "lora_B" in name:
+                param.normal_()
+    state_dict = {
+        key: value for key, value in helper.model.state_dict().items() if "lora_" in key
+    }
+    loaded = LoraWrapperRobertaHelper.load_lora(
+        {"model_id": model_id, "lora_rank": 4, **state_dict}
+    )
+    helper.model.eval()
+    loaded.model.eval()
+    with torch.no_grad():
+        torch.testing.assert_close(
+            loaded.model(input_ids).last_hidden_state,
+            helper.model(input_ids).last_hidden_state,
+        )
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="CUDA graphs need CUDA")
+def test_compiled_forward_matches_eager():
+    torch.manual_seed(0)
+    # Two layers, such that the graphs of one layer are not replayed with the parameters of the other
+    layers = [make_layer(use_cuda_graphs=True).cuda().eval() for _ in range(2)]
+    hidden_states = torch.randn(2, 5, 32, device="cuda")
+    with torch.no_grad():
+        # Warmup, recording and replay of the CUDA graphs
+        for _ in range(3):
+            for layer in layers:
+                expected = layer._forward_fast(hidden_states, None)[0]
+                output = layer(hidden_states)[0]
+                torch.testing.assert_close(output, expected, atol=1e-4, rtol=1e-4)